@@ -1,19 +1,47 @@
 from abc import ABC, abstractmethod
+from contextlib import contextmanager
 import torch
 import numpy as np
 from absl.logging import flush
 from torch.onnx.symbolic_opset9 import tensor
 from torchvision import transforms
+from torchvision.ops import roi_align
+from kornia.geometry.transform import warp_affine
 import inference  # from AdaFace
-from face_alignment import align, mtcnn  # from AdaFace
+from facenet_pytorch import MTCNN as FacenetMTCNN
 from pathlib import Path
 from PIL import Image
-import torch.nn.functional as F
 from typing import Tuple, List
 import clip
+import hashlib
+import json
+import logging
 import os
+import threading
 import ImageReward as RM
 
+log = logging.getLogger(__name__)
+
+# loaded models, keyed by (name, device) and shared across reward instances so
+# composite rewards don't pay the VRAM and load time twice; the lock guards the
+# first load of each entry
+_ADAFACE_MODEL_CACHE = {}
+_MTCNN_CACHE = {}
+_IMAGE_REWARD_CACHE = {}
+_MODEL_CACHE_LOCK = threading.Lock()
+
+
+@contextmanager
+def _cwd(path):
+    """Temporarily switch the working directory, restoring it even on failure."""
+    original_dir = os.getcwd()
+    os.chdir(path)
+    try:
+        yield
+    finally:
+        os.chdir(original_dir)
+
+
 __REWARD_METHOD__ = {}
 
 
@@ -92,13 +120,24 @@ class AdaFaceReward(Reward):
         model: Pretrained AdaFace embedding model.
         side_info (torch.Tensor): Ground-truth face embedding.
         device (str): Computation device, e.g., 'cuda' or 'cpu'.
-        mtcnn_model: Face detector and aligner (MTCNN).
+        batched_mtcnn: Batched face/landmark detector (MTCNN).
         res (int): Target image resolution for preprocessing.
     """
     ADAFACE_PATH = '../../third_party/AdaFace'
 
+    # 5-landmark reference template for a square 112x112 crop, identical to
+    # AdaFace's get_reference_facial_points(default_square=True)
+    _ALIGN_TEMPLATE = torch.tensor([
+        [38.2946, 51.6963],
+        [73.5318, 51.5014],
+        [56.0252, 71.7366],
+        [41.5493, 92.3655],
+        [70.7299, 92.2041],
+    ])
+
     def __init__(self, data_path: str = '../../data/additional_images', pretrained_model: str = 'ir_50',
-                 resolution: int = 256, device: str = 'cuda:0', scale=1, **kwargs):
+                 resolution: int = 256, device: str = 'cuda:0', scale=1, dtype: str = 'fp32',
+                 metric: str = 'sqr_l2', **kwargs):
         """
         Initializes the AdaFaceReward class.
 
@@ -107,29 +146,83 @@ class AdaFaceReward(Reward):
             pretrained_model (str): Name of the pretrained AdaFace model to load.
             resolution (int): Target resolution to resize and center crop images.
             device (str): Torch device for inference, default is 'cuda:0'.
+            dtype (str): 'fp16'/'bf16' run the model forward under autocast,
+                'fp32' (default) keeps full precision.
+            metric (str): 'sqr_l2' (default) ranks by squared L2 distance and
+                skips the sqrt; 'l2' restores the plain L2 distance.
             **kwargs: Additional unused keyword arguments.
         """
         super().__init__(**kwargs)
-        file_types = ['*.jpg', '*.JPG', '*.jpeg', '*.JPEG', '*.png', '*.PNG']
         self.device = device
-        self.files = sorted([f for ft in file_types for f in Path(data_path).rglob(ft)])
+        self._embed_cache_dir = Path('~/.cache/adaface_embeds').expanduser()
+        self._embed_cache_dir.mkdir(parents=True, exist_ok=True)
+        self.files = self._load_file_list(data_path)
 
-        original_dir = os.getcwd()
-        os.chdir(self.ADAFACE_PATH)
-        self.model = inference.load_pretrained_model(pretrained_model).to(self.device)
-        os.chdir(original_dir)
+        with _MODEL_CACHE_LOCK:
+            model_key = (pretrained_model, str(self.device))
+            if model_key not in _ADAFACE_MODEL_CACHE:
+                with _cwd(self.ADAFACE_PATH):
+                    _ADAFACE_MODEL_CACHE[model_key] = inference.load_pretrained_model(pretrained_model).to(self.device)
+            self.model = _ADAFACE_MODEL_CACHE[model_key]
 
         self.side_info = None
-        self.mtcnn_model = mtcnn.MTCNN(device=self.device, crop_size=(112, 112))
+        with _MODEL_CACHE_LOCK:
+            mtcnn_key = ('mtcnn', str(self.device))
+            if mtcnn_key not in _MTCNN_CACHE:
+                # only detect() is used — it is the one facenet-pytorch entry
+                # point that accepts GPU tensor batches
+                _MTCNN_CACHE[mtcnn_key] = FacenetMTCNN(keep_all=False, device=self.device)
+            self.batched_mtcnn = _MTCNN_CACHE[mtcnn_key]
         self.res = resolution
+        self._preproc = transforms.Compose([
+            transforms.ToTensor(),
+            transforms.Resize(self.res),
+            transforms.CenterCrop(self.res)
+        ])
         self.scale = scale
         self.name = 'adaface'
         self.embed_size = 512
+        self.pretrained_model = pretrained_model
+        self.dtype = dtype
+        self._autocast_dtype = {'fp16': torch.float16, 'bf16': torch.bfloat16}.get(dtype)
+        self.metric = metric
+        self._embed_stream = None  # lazily created CUDA stream for pipelined embedding
+
+    def _autocast(self):
+        """Autocast context for the model forward; a no-op when dtype is fp32."""
+        return torch.autocast(device_type='cuda' if 'cuda' in str(self.device) else 'cpu',
+                              dtype=self._autocast_dtype or torch.float16,
+                              enabled=self._autocast_dtype is not None)
+
+    def _load_file_list(self, data_path: str) -> List[Path]:
+        """
+        Returns the sorted image file list for `data_path`, cached in a JSON
+        sidecar keyed on the directory mtime so repeated experiments skip the
+        directory walk entirely.
+        """
+        listing_key = hashlib.sha1(str(Path(data_path).resolve()).encode()).hexdigest()
+        listing_path = self._embed_cache_dir / f'files_{listing_key}.json'
+        dir_mtime = os.path.getmtime(data_path)
+
+        if listing_path.exists():
+            cached = json.loads(listing_path.read_text())
+            if cached.get('mtime') == dir_mtime:
+                return [Path(p) for p in cached['files']]
+
+        # single recursive pass with a suffix-set lookup, instead of one
+        # rglob per extension/case variant
+        exts = {'.jpg', '.jpeg', '.png'}
+        files = sorted(p for p in Path(data_path).rglob('*') if p.suffix.lower() in exts)
+        listing_path.write_text(json.dumps({'mtime': dir_mtime, 'files': [str(f) for f in files]}))
+        return files
 
     def get_reward(self, images: torch.Tensor, **kwargs) -> torch.Tensor:
         """
-        Computes the negative L2 distance between the embeddings of given images
-        and the stored ground-truth embedding.
+        Computes the negative (squared) L2 distance between the embeddings of
+        given images and the stored ground-truth embedding.
+
+        The squared distance ranks identically to the plain L2 distance (sqrt
+        is monotonic) and matches the objective used in `get_gradients`.
 
         Args:
             images (torch.Tensor): Input batch of images (B, C, H, W) in [-1, 1].
@@ -138,7 +231,10 @@ class AdaFaceReward(Reward):
             torch.Tensor: A tensor of shape B containing reward values.
         """
         embed = self._embeddings(images)
-        return - torch.norm(self.side_info - embed, dim=1)
+        diff = self.side_info - embed
+        if self.metric == 'l2':
+            return - torch.norm(diff, dim=1)
+        return - (diff * diff).sum(dim=1)
 
     def set_side_info(self, index: int) -> None:
         """
@@ -148,25 +244,107 @@ class AdaFaceReward(Reward):
         Args:
             index (int): Index of the reference image in the dataset list.
         """
+        # Reference embeddings are static per (file, model, resolution), so
+        # load them from the on-disk cache when possible.
+        src = self.files[index]
+        key = hashlib.sha1(
+            f'{src}|{os.path.getmtime(src)}|{self.pretrained_model}|{self.res}'.encode()
+        ).hexdigest()
+        cache_path = self._embed_cache_dir / f'{key}.pt'
+        if cache_path.exists():
+            self.side_info = torch.load(cache_path, map_location=self.device)
+            if self._autocast_dtype is not None:
+                self.side_info = self.side_info.to(self._autocast_dtype)
+            return
+
         # Load and preprocess image
-        img = Image.open(self.files[index]).convert("RGB")
-        trans = transforms.Compose([
-            transforms.ToTensor(),
-            transforms.Resize(self.res),
-            transforms.CenterCrop(self.res)
-        ])
-        img_tensor = (trans(img) * 2 - 1).to(self.device)
+        img = Image.open(src).convert("RGB")
+        img_tensor = (self._preproc(img) * 2 - 1).to(self.device)
         if img_tensor.shape[0] == 1:
             img_tensor = img_tensor.expand(3, -1, -1)
 
-        # Set side information
-        self.side_info = self._embeddings(img_tensor.unsqueeze(0)).detach()
+        # Set side information (clone so the inference-mode output can be used
+        # in the autograd graph of get_gradients)
+        self.side_info = self._embeddings(img_tensor.unsqueeze(0)).detach().clone()
+        torch.save(self.side_info.float().cpu(), cache_path)
+        if self._autocast_dtype is not None:
+            self.side_info = self.side_info.to(self._autocast_dtype)
+
+    def _similarity_transforms(self, src: torch.Tensor) -> torch.Tensor:
+        """
+        Solves the 4-DoF similarity transform (scale, rotation, translation)
+        mapping each set of 5 source landmarks onto `_ALIGN_TEMPLATE`.
+
+        Args:
+            src (torch.Tensor): Detected landmarks of shape (B, 5, 2).
+
+        Returns:
+            torch.Tensor: Affine matrices of shape (B, 2, 3).
+        """
+        B = src.size(0)
+        # linear system for [a, b, tx, ty] with M = [[a, -b, tx], [b, a, ty]]
+        A = src.new_zeros((B, 10, 4))
+        A[:, 0::2, 0] = src[:, :, 0]
+        A[:, 0::2, 1] = -src[:, :, 1]
+        A[:, 0::2, 2] = 1
+        A[:, 1::2, 0] = src[:, :, 1]
+        A[:, 1::2, 1] = src[:, :, 0]
+        A[:, 1::2, 3] = 1
+        rhs = self._ALIGN_TEMPLATE.to(src).reshape(-1).expand(B, 10).unsqueeze(-1)
+        a, b, tx, ty = torch.linalg.lstsq(A, rhs).solution.squeeze(-1).unbind(-1)
+        return torch.stack([torch.stack([a, -b, tx], dim=-1),
+                            torch.stack([b, a, ty], dim=-1)], dim=-2)
+
+    def _align_faces(self, tensor_images: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+        """
+        Aligns a batch with one batched MTCNN detection pass (a single
+        PNet/RNet/ONet forward over (B, H, W, 3)) followed by a batched
+        similarity-transform warp onto the 112x112 ArcFace template — the same
+        alignment AdaFace was trained on — with the crops built on `self.device`.
+
+        Returns the model-ready (B, 3, 112, 112) input and a boolean mask
+        marking images where no face was detected.
+        """
+        B = tensor_images.size(0)
+        with torch.inference_mode():
+            images = ((tensor_images + 1) / 2 * 255).clamp(0, 255)
+            _, _, landmarks = self.batched_mtcnn.detect(images.byte().permute(0, 2, 3, 1), landmarks=True)
+
+            failed_mask = torch.zeros(B, dtype=torch.bool, device=self.device)
+            src = torch.empty((B, 5, 2), dtype=torch.float32)
+            for i in range(B):
+                if landmarks[i] is None:
+                    print('No face detected in x0 at index {0}, adding fallback embedding.'.format(i), flush=True)
+                    failed_mask[i] = True
+                    src[i] = self._ALIGN_TEMPLATE  # identity warp; this embedding is masked out anyway
+                else:
+                    src[i] = torch.from_numpy(np.asarray(landmarks[i][0], dtype=np.float32))
+
+            transforms_m = self._similarity_transforms(src.to(self.device))
+            batch_input = warp_affine(images, transforms_m, dsize=(112, 112))
+            # AdaFace expects BGR channel order scaled to [-1, 1] (see inference.to_input)
+            batch_input = (batch_input.flip(1) / 255.0 - 0.5) / 0.5
+        return batch_input, failed_mask
+
+    def _embed_faces(self, batch_input: torch.Tensor, failed_mask: torch.Tensor) -> torch.Tensor:
+        """Runs the AdaFace forward and writes fallback embeddings for failed rows."""
+        # no caller differentiates through this path (get_gradients runs its
+        # own forward), so skip autograd bookkeeping entirely
+        with torch.inference_mode(), self._autocast():
+            embeddings, _ = self.model(batch_input)
+            embeddings = torch.where(failed_mask.unsqueeze(1),
+                                     torch.full_like(embeddings, 1e3),
+                                     embeddings)
+        return embeddings
 
     def _embeddings(self, tensor_images: torch.Tensor) -> torch.Tensor:
         """
         Computes AdaFace embeddings for a batch of images.
 
-        Each image is aligned using MTCNN and passed through the pretrained model.
+        On CUDA the batch is split in two and pipelined: MTCNN alignment blocks
+        the host on its detections, so while one half embeds asynchronously on
+        a side stream the host already aligns the other half, hiding detection
+        latency behind embedding compute.
 
         Args:
             tensor_images (torch.Tensor): Batch of images (B, C, H, W) in [-1, 1].
@@ -174,27 +352,22 @@ class AdaFaceReward(Reward):
         Returns:
             torch.Tensor: A tensor of shape (B, D) with D-dimensional embeddings.
         """
-        tensor_images = ((tensor_images + 1) / 2 * 255).clamp(0, 255).byte()
-        to_pil = transforms.ToPILImage()
-
-        aligned_images, failed_indices = [], []
-        for i in range(tensor_images.size(0)):
-            try:
-                img = to_pil(tensor_images[i])
-                aligned = align.get_aligned_face('', rgb_pil_image=img)
-                aligned_images.append(inference.to_input(aligned).to(self.device))
-            except Exception as e:
-                print('No face detected in x0 at index {0}, adding fallback embedding.'.format(i), flush=True)
-                failed_indices.append(i)
-                aligned_images.append(torch.randn((1, 3, 112, 112), device=self.device))
-
-        batch_input = torch.cat(aligned_images, dim=0)  # Assuming dim=0 is batch
-        embeddings, _ = self.model(batch_input)
-        if failed_indices:
-            fallback = torch.ones((len(failed_indices), self.embed_size), device=embeddings.device) * 1e3
-            embeddings[torch.tensor(failed_indices, device=embeddings.device)] = fallback
-
-        return embeddings
+        if not tensor_images.is_cuda or tensor_images.size(0) < 2:
+            return self._embed_faces(*self._align_faces(tensor_images))
+
+        if self._embed_stream is None:
+            self._embed_stream = torch.cuda.Stream()
+
+        outputs = []
+        for chunk in tensor_images.chunk(2, dim=0):
+            batch_input, failed_mask = self._align_faces(chunk)
+            self._embed_stream.wait_stream(torch.cuda.current_stream())
+            with torch.cuda.stream(self._embed_stream):
+                batch_input.record_stream(self._embed_stream)
+                failed_mask.record_stream(self._embed_stream)
+                outputs.append(self._embed_faces(batch_input, failed_mask))
+        torch.cuda.current_stream().wait_stream(self._embed_stream)
+        return torch.cat(outputs, dim=0)
 
     def get_gradients(self, images: torch.Tensor, **kwargs) -> Tuple[torch.Tensor, torch.Tensor]:
 
@@ -202,21 +375,19 @@ class AdaFaceReward(Reward):
         images = images.clone().detach().requires_grad_(True)
 
         # ------------------------------------------------------------------
-        # 1. Detect faces (no grad)
+        # 1. Detect faces (no grad) — one batched pass, everything on device
         # ------------------------------------------------------------------
-        to_pil = transforms.ToPILImage()
-        bboxes, failed = [], []
+        with torch.inference_mode():
+            uint8_batch = ((images.detach() + 1) * 127.5).clamp(0, 255).byte().permute(0, 2, 3, 1).contiguous()
+            boxes, _ = self.batched_mtcnn.detect(uint8_batch)
 
+        bboxes, failed = [], []
         for i in range(B):
-            img_uint8 = ((images[i].detach() + 1) * 127.5).clamp(0, 255).byte().cpu()
-            pil_img = to_pil(img_uint8)
-            boxes, _ = self.mtcnn_model.align_multi(pil_img, limit=1)
-
-            if len(boxes) == 0:  # fallback → use whole frame
+            if boxes[i] is None:  # fallback → use whole frame
                 failed.append(i)
                 bboxes.append(None)
             else:
-                x1, y1, x2, y2 = boxes[0][:4].astype(int)
+                x1, y1, x2, y2 = boxes[i][0][:4].astype(int)
                 # Clamp to valid range
                 x1, y1 = max(x1, 0), max(y1, 0)
                 x2, y2 = min(x2, W - 1), min(y2, H - 1)
@@ -225,23 +396,21 @@ class AdaFaceReward(Reward):
         # ------------------------------------------------------------------
         # 2. Differentiable crop → ( B , 3 , 112 , 112 )
         # ------------------------------------------------------------------
-        face_tensors = []
-        for i, bb in enumerate(bboxes):
-            if bb is None:
-                crop = torch.zeros((1, 3, 112, 112), device=images.device)
-            else:
-                x1, y1, x2, y2 = bb
-                crop = images[i: i + 1, :, y1: y2 + 1, x1: x2 + 1]  # keeps grad
-                crop = F.interpolate(crop, size=(112, 112),
-                                     mode='bilinear', align_corners=False)
-            face_tensors.append(crop)
-
-        faces = torch.cat(face_tensors, dim=0)  # (B, 3, 112, 112)
+        # roi_align fuses the per-box crop + bilinear resize into one batched
+        # kernel and still feeds gradients back to `images`
+        rois = torch.tensor(
+            [[i, 0.0, 0.0, W - 1.0, H - 1.0] if bb is None else [i, *map(float, bb)]
+             for i, bb in enumerate(bboxes)],
+            device=images.device, dtype=images.dtype
+        )
+        faces = roi_align(images, rois, output_size=(112, 112),
+                          spatial_scale=1.0, aligned=True)  # (B, 3, 112, 112)
 
         # ------------------------------------------------------------------
         # 3. Embeddings
         # ------------------------------------------------------------------
-        embeds, _ = self.model(faces)  # (B, D)
+        with self._autocast():
+            embeds, _ = self.model(faces)  # (B, D)
 
         # ------------------------------------------------------------------
         # 4. L2 distance to reference embedding
@@ -427,19 +596,22 @@ class TextAlignmentReward(Reward):
     def __init__(self, data_path: str = 'dataset/si_daps/additional_texts', pretrained_model: str = 'ImageReward-v1.0',
                  resolution: int = 256, device: str = 'cuda:0', scale=1, **kwargs):
         super().__init__(**kwargs)
-        file_types = ['*.txt']
         self.device = device
 
-        files = [f for f in os.listdir(data_path) if f.lower().endswith('.txt')]
-        files.sort()
-        self.files: List[str] = [os.path.join(data_path, f) for f in files]
-        print(30 * '-')
-        print('in constructor of TextAlignmentReward: ')
-        print('self.files are: ', self.files)
-        print(30 * '-')
-
-        # this will download the ViT-B/32 weights on first run
-        self.model = RM.load(pretrained_model, device=device)
+        # single scandir pass instead of listdir + join per file
+        with os.scandir(data_path) as entries:
+            self.files: List[str] = sorted(e.path for e in entries
+                                           if e.is_file() and e.name.lower().endswith('.txt'))
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug('in constructor of TextAlignmentReward, self.files are: %s', self.files)
+
+        # this will download the weights on first run; loaded models are
+        # shared across instances on the same device
+        with _MODEL_CACHE_LOCK:
+            model_key = (pretrained_model, str(device))
+            if model_key not in _IMAGE_REWARD_CACHE:
+                _IMAGE_REWARD_CACHE[model_key] = RM.load(pretrained_model, device=device)
+            self.model = _IMAGE_REWARD_CACHE[model_key]
         #self.model, self.preprocess = clip.load("ViT-B/32", device=device)
         self.model.eval()
         self.side_info = None
@@ -448,25 +620,18 @@ class TextAlignmentReward(Reward):
 
 
     def get_reward(self, images: torch.Tensor, **kwargs) -> torch.Tensor:
-        tensor_images = ((images + 1) / 2 * 255).clamp(0, 255).byte()
+        # Do the [-1, 1] -> uint8 conversion in one kernel and move the whole
+        # batch to host in a single transfer instead of one sync per image.
+        arr = ((images + 1) * 127.5).clamp(0, 255).to(torch.uint8).permute(0, 2, 3, 1).contiguous().cpu().numpy()
 
-        print(30 * '$', flush=True)
-        print(torch.norm(images[0] - images[1]), flush=True)
-        print(images.min(), flush=True)
-        print(images.max(), flush=True)
-        print(30 * '$', flush=True)
-
-        to_pil = transforms.ToPILImage()
-
-        # convert each tensor to a PIL image that ImageReward expects
-        pil_imgs = [to_pil(img.cpu()) for img in tensor_images]
+        # zero-copy views into the host buffer, in the layout ImageReward expects
+        pil_imgs = [Image.fromarray(arr[i]) for i in range(arr.shape[0])]
 
         with torch.no_grad():
             _, rewards = self.model.inference_rank(self.side_info, pil_imgs)  # `rewards` is a list of floats
 
-        print(30 * '-', flush=True)
-        print('rewards are: ', rewards)
-        print(30 * '-', flush=True)
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug('rewards are: %s', rewards)
         return torch.tensor(rewards).to(self.device)
 
     def set_side_info(self, index: int) -> None:
@@ -474,9 +639,8 @@ class TextAlignmentReward(Reward):
         with open(path, 'r', encoding='utf-8') as fp:
             text = fp.read()
         self.side_info = text
-        print(30 * '-', flush=True)
-        print('side info is: ', self.side_info)
-        print(30 * '-', flush=True)
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug('side info is: %s', self.side_info)
 
     def get_gradients(self, particles, **kwargs) -> torch.Tensor:
         return None
\ No newline at end of file
@@ -128,54 +128,55 @@ class GroupMeetingSearch(Search):
         if step % self.base != 0 or step == 0:
             return np.arange(N, dtype=int)
 
-        # prepare data
-        rewards_np = rewards.cpu().detach().numpy()
-        norm_dist = 1 - (rewards_np - rewards_np.min()) / (
-                (rewards_np.max() - rewards_np.min()) + 1e-8
-        )
-        scores = np.exp(-self.normalizing_factor * norm_dist ** 2)
+        # prepare data — stay on the rewards device, sync to host only once at return
+        r = rewards.detach()
 
         # compute group size
         raw_groups = (step // self.base) & -(step // self.base)
-        group_size = min(raw_groups * self.min_group, self.max_group)
-
-        all_selected = []
-
-        # process each group in turn
-        for start in range(0, N, group_size):
-            end = min(start + group_size, N)
-            gs = end - start
-
-            if mode == 'probabilistic':
-                grp_scores = scores[start:end]
-                grp_scores = grp_scores / grp_scores.sum()
-                choices = np.random.choice(
-                    np.arange(start, end),
-                    size=gs,
-                    replace=True,
-                    p=grp_scores
-                )
-                all_selected.extend(choices.tolist())
-
-            elif mode == 'deterministic':
-                grp_rew = rewards_np[start:end]
-                # descending sort
-                order = np.argsort(-grp_rew)
-                best_idx = start + order[0]
-                # runner‑up if it exists
-                second_idx = start + order[1] if gs > 1 else best_idx
-
-                # how many runner‑up picks?
-                second_count = math.ceil(gs / 8) if gs >= 8 else 0
-                first_count = gs - second_count
-
-                # build the list for this group
-                sel_group = [best_idx] * first_count + [second_idx] * second_count
-                all_selected.extend(sel_group)
-
-            else:
-                raise ValueError(f"Unknown mode: {mode!r}")
-        return np.array(all_selected, dtype=int)
+        group_size = min(raw_groups * self.min_group, self.max_group, N)
+
+        # the reshape below requires the groups to tile N exactly; num_particles
+        # is validated as a power of 2, but min_group/max_group come straight
+        # from config, so enforce the assumption instead of assuming it
+        if N % group_size:
+            raise ValueError(
+                f'group size {group_size} does not evenly divide num_particles {N}; '
+                'min_group and max_group must be powers of 2'
+            )
+        G = N // group_size
+        starts = torch.arange(G, device=r.device) * group_size
+
+        if mode == 'probabilistic':
+            # scores are only needed for sampling, so the deterministic
+            # branch never pays for the normalization and exp
+            norm_dist = 1 - (r - r.min()) / ((r.max() - r.min()) + 1e-8)
+            scores = torch.exp(-self.normalizing_factor * norm_dist ** 2)
+
+            # one multinomial draw per group, all groups at once
+            choices = torch.multinomial(scores.view(G, group_size),
+                                        num_samples=group_size, replacement=True)
+            selected = starts[:, None] + choices
+            return selected.reshape(-1).cpu().numpy()
+
+        elif mode == 'deterministic':
+            # only the top two entries per group matter, so use a k=2 topk
+            # instead of fully sorting every group
+            _, top2 = torch.topk(r.view(G, group_size), k=min(2, group_size), dim=1)
+            best_idx = starts + top2[:, 0]
+            # runner‑up if it exists
+            second_idx = starts + top2[:, 1] if group_size > 1 else best_idx
+
+            # how many runner‑up picks?
+            second_count = math.ceil(group_size / 8) if group_size >= 8 else 0
+            first_count = group_size - second_count
+
+            cols = torch.arange(group_size, device=r.device)
+            selected = torch.where(cols[None, :] < first_count,
+                                   best_idx[:, None], second_idx[:, None])
+            return selected.reshape(-1).cpu().numpy()
+
+        else:
+            raise ValueError(f"Unknown mode: {mode!r}")
 
 
 @register_search_method('best-of-n')